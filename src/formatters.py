@@ -2,63 +2,88 @@
 Smart formatters for common webhook sources
 """
 import json
+from collections.abc import Mapping
 from typing import Any
 
+# Shared read-only fallback for missing nested objects
+_EMPTY: dict = {}
+
+
+def _fmt_push(payload: dict, repo_d: dict, repo: str, sender: str, event: str | None) -> str:
+    branch = payload.get("ref", "").replace("refs/heads/", "")
+    commits = payload.get("commits", [])
+    lines = [
+        f"🔨 <b>Push to {repo}</b>",
+        f"Branch: <code>{branch}</code>",
+        f"By: {sender}",
+        f"Commits: {len(commits)}",
+    ]
+    for c in commits[:3]:
+        msg = c.get("message", "").split("\n")[0][:50]
+        lines.append(f"  • {msg}")
+    if len(commits) > 3:
+        lines.append(f"  ... and {len(commits) - 3} more")
+    return "\n".join(lines)
+
+
+def _fmt_pr(payload: dict, repo_d: dict, repo: str, sender: str, event: str | None) -> str:
+    action = payload.get("action", "")
+    pr = payload.get("pull_request") or _EMPTY
+    title = pr.get("title", "")[:50]
+    number = pr.get("number", "?")
+    return f"🔀 <b>PR #{number} {action}</b>\n{repo}\n{title}\nBy: {sender}"
+
+
+def _fmt_issue(payload: dict, repo_d: dict, repo: str, sender: str, event: str | None) -> str:
+    action = payload.get("action", "")
+    issue = payload.get("issue") or _EMPTY
+    title = issue.get("title", "")[:50]
+    number = issue.get("number", "?")
+    return f"📋 <b>Issue #{number} {action}</b>\n{repo}\n{title}\nBy: {sender}"
+
+
+def _fmt_star(payload: dict, repo_d: dict, repo: str, sender: str, event: str | None) -> str:
+    action = payload.get("action", "created")
+    stars = repo_d.get("stargazers_count", "?")
+    return f"⭐ <b>{repo}</b>\n{sender} {'starred' if action == 'created' else 'unstarred'}\nTotal: {stars}"
+
+
+def _fmt_release(payload: dict, repo_d: dict, repo: str, sender: str, event: str | None) -> str:
+    action = payload.get("action", "")
+    release = payload.get("release") or _EMPTY
+    tag = release.get("tag_name", "?")
+    return f"🚀 <b>Release {action}: {tag}</b>\n{repo}\nBy: {sender}"
+
+
+def _fmt_default(payload: dict, repo_d: dict, repo: str, sender: str, event: str | None) -> str:
+    return f"📦 <b>GitHub: {event or 'event'}</b>\n{repo}\nBy: {sender}"
+
+
+# GitHub event name -> formatter
+_GH_HANDLERS = {
+    "push": _fmt_push,
+    "pull_request": _fmt_pr,
+    "issues": _fmt_issue,
+    "star": _fmt_star,
+    "release": _fmt_release,
+}
+
 
 def format_github(payload: dict, event: str | None) -> str:
     """Format GitHub webhook payload."""
-    repo = payload.get("repository", {}).get("full_name", "unknown")
-    sender = payload.get("sender", {}).get("login", "unknown")
-    
-    if event == "push":
-        branch = payload.get("ref", "").replace("refs/heads/", "")
-        commits = payload.get("commits", [])
-        lines = [
-            f"🔨 <b>Push to {repo}</b>",
-            f"Branch: <code>{branch}</code>",
-            f"By: {sender}",
-            f"Commits: {len(commits)}",
-        ]
-        for c in commits[:3]:
-            msg = c.get("message", "").split("\n")[0][:50]
-            lines.append(f"  • {msg}")
-        if len(commits) > 3:
-            lines.append(f"  ... and {len(commits) - 3} more")
-        return "\n".join(lines)
-    
-    elif event == "pull_request":
-        action = payload.get("action", "")
-        pr = payload.get("pull_request", {})
-        title = pr.get("title", "")[:50]
-        number = pr.get("number", "?")
-        return f"🔀 <b>PR #{number} {action}</b>\n{repo}\n{title}\nBy: {sender}"
-    
-    elif event == "issues":
-        action = payload.get("action", "")
-        issue = payload.get("issue", {})
-        title = issue.get("title", "")[:50]
-        number = issue.get("number", "?")
-        return f"📋 <b>Issue #{number} {action}</b>\n{repo}\n{title}\nBy: {sender}"
-    
-    elif event == "star":
-        action = payload.get("action", "created")
-        stars = payload.get("repository", {}).get("stargazers_count", "?")
-        return f"⭐ <b>{repo}</b>\n{sender} {'starred' if action == 'created' else 'unstarred'}\nTotal: {stars}"
-    
-    elif event == "release":
-        action = payload.get("action", "")
-        release = payload.get("release", {})
-        tag = release.get("tag_name", "?")
-        return f"🚀 <b>Release {action}: {tag}</b>\n{repo}\nBy: {sender}"
-    
-    else:
-        return f"📦 <b>GitHub: {event or 'event'}</b>\n{repo}\nBy: {sender}"
+    repo_d = payload.get("repository") or _EMPTY
+    sender_d = payload.get("sender") or _EMPTY
+    repo = repo_d.get("full_name", "unknown")
+    sender = sender_d.get("login", "unknown")
+    # event may come from the payload ("action"), so it isn't guaranteed to be a str
+    handler = _GH_HANDLERS.get(event, _fmt_default) if isinstance(event, str) else _fmt_default
+    return handler(payload, repo_d, repo, sender, event)
 
 
 def format_stripe(payload: dict) -> str:
     """Format Stripe webhook payload."""
     event_type = payload.get("type", "unknown")
-    data = payload.get("data", {}).get("object", {})
+    data = (payload.get("data") or _EMPTY).get("object") or _EMPTY
     
     if "payment_intent" in event_type:
         amount = data.get("amount", 0) / 100
@@ -78,18 +103,22 @@ def format_stripe(payload: dict) -> str:
         return f"💳 <b>Stripe: {event_type}</b>"
 
 
+# Common fields to look for in generic payloads, in display order
+_INTERESTING = ("action", "event", "type", "status", "message", "name", "email", "url")
+_INTERESTING_SET = frozenset(_INTERESTING)
+
+
 def format_generic(payload: dict, source: str = "webhook") -> str:
     """Format any webhook payload generically."""
     # Try to extract useful info
     lines = [f"📨 <b>{source}</b>"]
     
-    # Common fields to look for
-    interesting_keys = ["action", "event", "type", "status", "message", "name", "email", "url"]
-    
-    for key in interesting_keys:
-        if key in payload:
-            value = str(payload[key])[:100]
-            lines.append(f"{key}: {value}")
+    present = payload.keys() & _INTERESTING_SET  # iterates the smaller side
+    if present:
+        for key in _INTERESTING:
+            if key in present:
+                value = str(payload[key])[:100]
+                lines.append(f"{key}: {value}")
     
     # If payload is small, include it
     if len(lines) == 1:
@@ -99,11 +128,14 @@ def format_generic(payload: dict, source: str = "webhook") -> str:
     return "\n".join(lines)
 
 
-def auto_format(payload: dict, headers: dict) -> str:
-    """Auto-detect source and format accordingly."""
+def auto_format(payload: dict, headers: Mapping[str, str]) -> str:
+    """Auto-detect source and format accordingly.
+    
+    `headers` must be case-insensitive (e.g. Starlette's Headers) or use lowercase keys.
+    """
     # GitHub
-    if "X-GitHub-Event" in headers or "x-github-event" in headers:
-        event = headers.get("X-GitHub-Event") or headers.get("x-github-event")
+    event = headers.get("x-github-event")
+    if event is not None:
         return format_github(payload, event)
     
     # Stripe
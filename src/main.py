@@ -3,44 +3,106 @@ Webhook Relay - Receive and forward webhooks to Telegram
 """
 import os
 import json
+import asyncio
 import hashlib
 import hmac
 import secrets
+import time
+from collections import OrderedDict
 from datetime import datetime, date
 from pathlib import Path
 from typing import Any
 
-from fastapi import FastAPI, Request, HTTPException, Header
+from fastapi import FastAPI, Request, Response, HTTPException, Header
 from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
+from starlette.datastructures import Headers
 from dotenv import load_dotenv
 import httpx
 
 from .formatters import auto_format, format_generic
 
+try:
+    import orjson
+    
+    json_loads = orjson.loads
+
+    def json_dumps(obj: Any, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+except ImportError:  # Fall back to stdlib json
+    json_loads = json.loads
+
+    def json_dumps(obj: Any, indent: bool = False) -> bytes:
+        return json.dumps(obj, indent=2 if indent else None).encode()
+
 load_dotenv()
 
 # Config
 DATA_DIR = Path(os.getenv("WEBHOOK_DATA_DIR", "/root/source/side-projects/webhook-relay/data"))
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+MAX_BODY = int(os.getenv("WEBHOOK_MAX_BODY", 1_048_576))  # bytes
+BODY_TIMEOUT = 5.0  # seconds to receive the full request body
+TELEGRAM_URL = (
+    f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage" if TELEGRAM_BOT_TOKEN else None
+)
+
+# Log writer: records are queued by the request path and flushed in batches
+LOG_FLUSH_INTERVAL = 0.01  # seconds to wait for more records before writing
+LOG_FLUSH_BATCH = 256  # max records per write
+
+# Upper bound on records returned by GET /logs
+LOGS_MAX_LIMIT = 1000
+
+# Telegram forwarding: webhooks are queued and sent by background workers
+TG_WORKERS = 8
+TG_QUEUE_SIZE = 10_000
+
+# channels.json writes are coalesced: at most one per burst of changes
+CHANNELS_SAVE_DELAY = 0.2  # seconds
+
+# Replay dedup: identical bodies on the same channel within the TTL are dropped
+DEDUP_TTL = 60.0  # seconds
+DEDUP_MAX = 4096  # entries kept in the LRU
+
+# Constant part of every sendMessage request
+_TG_BASE = {"parse_mode": "HTML", "disable_web_page_preview": True}
+_TG_HEADERS = {"Content-Type": "application/json"}
+
+# Header name prefixes worth keeping in the log (ASGI header names are lowercase)
+_INTERESTING_PREFIXES = (b"x-", b"content-")
 
 # In-memory channel registry (load from file on startup)
 channels: dict[str, dict] = {}
 
+_dedup: OrderedDict[bytes, float] = OrderedDict()  # body digest -> last seen (monotonic)
+_LAST_CHANNELS_HASH: bytes | None = None  # digest of the last channels.json written
+_LOG_FD: tuple[date, int] | None = None  # (day, fd) of the open daily log file
+
 
 def ensure_dirs():
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     (DATA_DIR / "logs").mkdir(exist_ok=True)
 
 
+def prepare_channel(channel: dict) -> dict:
+    """Attach derived, non-persisted fields (prefixed with _) to a channel."""
+    if channel.get("secret"):
+        channel["_secret_bytes"] = channel["secret"].encode()
+    return channel
+
+
 def load_channels():
     """Load channel config from file."""
-    global channels
+    global channels, _LAST_CHANNELS_HASH
     config_file = DATA_DIR / "channels.json"
     
     if config_file.exists():
-        channels = json.loads(config_file.read_text())
+        channels = json_loads(config_file.read_bytes())
+        for channel in channels.values():
+            prepare_channel(channel)
+        # What's on disk is current; don't rewrite it until something changes
+        _LAST_CHANNELS_HASH = _channels_digest(_dump_channels())
     else:
         # Create default channel
         channels = {
@@ -54,61 +116,229 @@ def load_channels():
         save_channels()
 
 
-def save_channels():
-    """Save channel config to file."""
+def _dump_channels() -> bytes:
+    """Serialize the persisted part of the channel config."""
+    return json_dumps(
+        {cid: {k: v for k, v in c.items() if not k.startswith("_")} for cid, c in channels.items()},
+        indent=True,
+    )
+
+
+def _channels_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _write_channels(data: bytes):
+    """Write serialized config atomically, skipping the write if nothing changed."""
+    global _LAST_CHANNELS_HASH
+    digest = _channels_digest(data)
+    if digest == _LAST_CHANNELS_HASH:
+        return
+    
     ensure_dirs()
     config_file = DATA_DIR / "channels.json"
-    config_file.write_text(json.dumps(channels, indent=2))
+    tmp_file = config_file.with_suffix(".json.tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, config_file)
+    # Make the rename itself durable
+    dir_fd = os.open(DATA_DIR, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    _LAST_CHANNELS_HASH = digest
 
 
-def log_webhook(channel_id: str, payload: dict, headers: dict, forwarded: bool):
-    """Log webhook to daily file."""
-    ensure_dirs()
-    log_file = DATA_DIR / "logs" / f"{date.today().isoformat()}.jsonl"
-    
+def save_channels():
+    """Save channel config to file."""
+    _write_channels(_dump_channels())
+
+
+async def channels_flusher(dirty: asyncio.Event):
+    """Save channels once per burst of changes, off the event loop."""
+    while True:
+        await dirty.wait()
+        await asyncio.sleep(CHANNELS_SAVE_DELAY)
+        dirty.clear()
+        # Serialize on the loop so handlers can't mutate channels mid-dump
+        data = _dump_channels()
+        write = asyncio.ensure_future(asyncio.to_thread(_write_channels, data))
+        try:
+            await asyncio.shield(write)
+        except asyncio.CancelledError:
+            # Let an in-flight save land before shutdown writes the final state
+            await asyncio.wait([write])
+            raise
+        except OSError as e:
+            print(f"❌ Channel save error: {e}")
+
+
+def payload_preview(body: bytes, size: int = 500) -> str:
+    """Decode the first `size` bytes of a body, dropping a character cut at the edge."""
+    preview = body[:size]
+    try:
+        return preview.decode("utf-8")
+    except UnicodeDecodeError as e:
+        if e.reason == "unexpected end of data":
+            # Only the truncated tail is invalid; everything before it decoded fine
+            return preview[:e.start].decode("utf-8")
+        return preview.decode("utf-8", "replace")
+
+
+def log_webhook(channel_id: str, body: bytes, headers: Headers, forwarded: bool, dedup: bool = False):
+    """Queue webhook record for the background log writer."""
     record = {
         "channel": channel_id,
         "received_at": datetime.utcnow().isoformat(),
         "forwarded": forwarded,
-        "headers": {k: v for k, v in headers.items() if k.lower().startswith(("x-", "content-"))},
-        "payload_preview": json.dumps(payload)[:500],
+        "headers": {
+            k.decode("latin-1"): v.decode("latin-1")
+            for k, v in headers.raw
+            if k.startswith(_INTERESTING_PREFIXES)
+        },
+        "payload_preview": payload_preview(body),
     }
+    if dedup:
+        record["dedup"] = True
     
-    with open(log_file, "a") as f:
-        f.write(json.dumps(record) + "\n")
+    app.state.log_queue.put_nowait(json_dumps(record) + b"\n")
+
+
+def _get_log_fd() -> int:
+    """Return the fd for today's log file, reopening it when the date changes."""
+    global _LOG_FD
+    today = date.today()
+    if _LOG_FD is None or _LOG_FD[0] != today:
+        if _LOG_FD is not None:
+            os.close(_LOG_FD[1])
+            _LOG_FD = None
+        log_file = DATA_DIR / "logs" / f"{today.isoformat()}.jsonl"
+        _LOG_FD = (today, os.open(log_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644))
+    return _LOG_FD[1]
+
+
+def _close_log_fd():
+    global _LOG_FD
+    if _LOG_FD is not None:
+        os.close(_LOG_FD[1])
+        _LOG_FD = None
+
+
+def _write_log_batch(batch: list[bytes]):
+    try:
+        os.write(_get_log_fd(), b"".join(batch))
+    except OSError as e:
+        print(f"❌ Log write error: {e}")
+
+
+async def log_writer(queue: asyncio.Queue):
+    """Drain the log queue, coalescing records into one write per batch."""
+    loop = asyncio.get_running_loop()
+    batch: list[bytes] = []
+    try:
+        while True:
+            batch.append(await queue.get())
+            deadline = loop.time() + LOG_FLUSH_INTERVAL
+            while len(batch) < LOG_FLUSH_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            _write_log_batch(batch)
+            batch = []
+    finally:
+        # Flush the pending batch and whatever is still queued (e.g. on shutdown)
+        while not queue.empty():
+            batch.append(queue.get_nowait())
+        if batch:
+            _write_log_batch(batch)
+        _close_log_fd()
+
+
+async def read_body(request: Request) -> bytes:
+    """Read the request body, enforcing MAX_BODY and BODY_TIMEOUT."""
+    async def _read() -> bytes:
+        chunks = []
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > MAX_BODY:
+                raise HTTPException(status_code=413, detail="Payload too large")
+            chunks.append(chunk)
+        return b"".join(chunks)
+    
+    try:
+        return await asyncio.wait_for(_read(), timeout=BODY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=408, detail="Timed out reading body")
+
+
+def dedup_key(channel_id: str, body: bytes) -> bytes:
+    return hashlib.blake2b(channel_id.encode() + b"\0" + body, digest_size=16).digest()
+
+
+def is_duplicate(key: bytes) -> bool:
+    """Return True if a delivery with this key was accepted within DEDUP_TTL."""
+    seen = _dedup.get(key)
+    if seen is not None and time.monotonic() - seen < DEDUP_TTL:
+        _dedup.move_to_end(key)
+        return True
+    return False
+
+
+def mark_accepted(key: bytes):
+    """Record a delivery once it has been queued or forwarded."""
+    _dedup[key] = time.monotonic()
+    _dedup.move_to_end(key)
+    if len(_dedup) > DEDUP_MAX:
+        _dedup.popitem(last=False)
 
 
 async def send_telegram(chat_id: str, message: str) -> bool:
     """Send message to Telegram."""
-    if not TELEGRAM_BOT_TOKEN:
+    if not TELEGRAM_URL:
         print(f"⚠️ No bot token, would send to {chat_id}: {message[:100]}...")
         return False
     
-    url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-    
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            resp = await client.post(url, json={
-                "chat_id": chat_id,
-                "text": message,
-                "parse_mode": "HTML",
-                "disable_web_page_preview": True,
-            })
-            return resp.status_code == 200
+        resp = await app.state.tg_client.post(
+            TELEGRAM_URL,
+            content=json_dumps({**_TG_BASE, "chat_id": chat_id, "text": message}),
+            headers=_TG_HEADERS,
+        )
+        return resp.status_code == 200
     except Exception as e:
         print(f"❌ Telegram error: {e}")
         return False
 
 
-def verify_signature(payload: bytes, signature: str, secret: str, algorithm: str = "sha256") -> bool:
-    """Verify webhook signature (GitHub style: sha256=xxx)."""
-    if "=" in signature:
-        algo, sig = signature.split("=", 1)
-    else:
-        sig = signature
+async def telegram_worker(queue: asyncio.Queue):
+    """Forward queued webhooks to Telegram and log the result."""
+    while True:
+        channel_id, chat_id, message, body, headers = await queue.get()
+        try:
+            forwarded = await send_telegram(chat_id, message)
+            log_webhook(channel_id, body, headers, forwarded)
+        finally:
+            queue.task_done()
+
+
+def verify_signature(payload: bytes, signature: str, secret: bytes) -> bool:
+    """Verify webhook signature (GitHub style: sha256=xxx, or bare hex digest)."""
+    sig = signature.partition("=")[2] or signature
+    try:
+        sig_bytes = bytes.fromhex(sig)
+    except ValueError:
+        return False
     
-    expected = hmac.new(secret.encode(), payload, hashlib.sha256).hexdigest()
-    return hmac.compare_digest(expected, sig)
+    expected = hmac.digest(secret, payload, "sha256")
+    return hmac.compare_digest(expected, sig_bytes)
 
 
 # FastAPI app
@@ -123,9 +353,50 @@ app = FastAPI(
 async def startup():
     ensure_dirs()
     load_channels()
+    # Shared client: keeps the TLS connection to Telegram alive across webhooks
+    app.state.tg_client = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+    app.state.log_queue = asyncio.Queue()
+    app.state.log_writer = asyncio.create_task(log_writer(app.state.log_queue))
+    app.state.channels_dirty = asyncio.Event()  # set when channels need saving
+    app.state.channels_flusher = asyncio.create_task(channels_flusher(app.state.channels_dirty))
+    app.state.tg_queue = asyncio.Queue(maxsize=TG_QUEUE_SIZE)
+    app.state.tg_workers = [
+        asyncio.create_task(telegram_worker(app.state.tg_queue)) for _ in range(TG_WORKERS)
+    ]
     print(f"🚀 Webhook Relay started with {len(channels)} channels")
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    # Give queued messages a chance to go out before stopping the workers
+    try:
+        await asyncio.wait_for(app.state.tg_queue.join(), timeout=5.0)
+    except asyncio.TimeoutError:
+        print(f"⚠️ Dropping {app.state.tg_queue.qsize()} queued Telegram messages")
+    for worker in app.state.tg_workers:
+        worker.cancel()
+    await asyncio.gather(*app.state.tg_workers, return_exceptions=True)
+    await app.state.tg_client.aclose()
+    
+    # Persist any channel changes still waiting on the debounce
+    app.state.channels_flusher.cancel()
+    try:
+        await app.state.channels_flusher
+    except asyncio.CancelledError:
+        pass
+    save_channels()
+    
+    app.state.log_writer.cancel()
+    try:
+        await app.state.log_writer
+    except asyncio.CancelledError:
+        pass
+
+
 @app.get("/")
 async def root():
     return {
@@ -144,52 +415,77 @@ async def root():
 async def receive_webhook(
     channel_id: str,
     request: Request,
+    response: Response,
     x_hub_signature_256: str | None = Header(None),
     x_webhook_signature: str | None = Header(None),
 ):
     """Receive a webhook and forward to Telegram."""
     
+    # Reject oversized bodies before reading them
+    try:
+        content_length = int(request.headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if content_length > MAX_BODY:
+        raise HTTPException(status_code=413, detail="Payload too large")
+    
     # Get channel config
     channel = channels.get(channel_id)
     if not channel:
         raise HTTPException(status_code=404, detail=f"Channel '{channel_id}' not found")
     
-    # Read body
-    body = await request.body()
+    # Read body (also bounded when there is no Content-Length, e.g. chunked)
+    body = await read_body(request)
     
     # Verify signature if channel has a secret
     if channel.get("secret"):
         signature = x_hub_signature_256 or x_webhook_signature
         if not signature:
             raise HTTPException(status_code=401, detail="Missing signature")
-        if not verify_signature(body, signature, channel["secret"]):
+        if not verify_signature(body, signature, channel["_secret_bytes"]):
             raise HTTPException(status_code=401, detail="Invalid signature")
     
+    headers = request.headers
+    
+    # Upstream retries of a delivery we already accepted
+    key = dedup_key(channel_id, body)
+    if is_duplicate(key):
+        log_webhook(channel_id, body, headers, False, dedup=True)
+        return {"ok": True, "forwarded": False, "dedup": True}
+    
+    # Nowhere to send: log and skip parsing/formatting entirely
+    chat_id = channel.get("telegram_chat_id") or TELEGRAM_CHAT_ID
+    if not chat_id:
+        print(f"⚠️ No chat_id for channel {channel_id}")
+        log_webhook(channel_id, body, headers, False)
+        return {"ok": True, "forwarded": False}
+    
     # Parse payload
     try:
-        payload = json.loads(body)
+        payload = json_loads(body)
     except json.JSONDecodeError:
         payload = {"raw": body.decode("utf-8", errors="replace")[:1000]}
     
-    # Get headers as dict
-    headers = dict(request.headers)
-    
     # Format message
     message = auto_format(payload, headers)
     
     # Add channel tag
     message = f"[{channel.get('name', channel_id)}]\n{message}"
     
-    # Send to Telegram
-    chat_id = channel.get("telegram_chat_id") or TELEGRAM_CHAT_ID
-    if chat_id:
+    # Queue for Telegram; the worker logs once the send completes
+    try:
+        request.app.state.tg_queue.put_nowait((channel_id, chat_id, message, body, headers))
+    except asyncio.QueueFull:
         forwarded = await send_telegram(chat_id, message)
+        if forwarded:
+            mark_accepted(key)
     else:
-        forwarded = False
-        print(f"⚠️ No chat_id for channel {channel_id}")
+        mark_accepted(key)
+        response.status_code = 202
+        return {"ok": True, "queued": True}
     
     # Log
-    log_webhook(channel_id, payload, headers, forwarded)
+    log_webhook(channel_id, body, headers, forwarded)
     
     return {"ok": True, "forwarded": forwarded}
 
@@ -231,13 +527,13 @@ async def create_channel(data: ChannelCreate):
     # Generate unique ID
     channel_id = secrets.token_urlsafe(8)
     
-    channels[channel_id] = {
+    channels[channel_id] = prepare_channel({
         "name": data.name,
         "telegram_chat_id": data.telegram_chat_id,
         "secret": data.secret,
         "created_at": datetime.utcnow().isoformat(),
-    }
-    save_channels()
+    })
+    app.state.channels_dirty.set()
     
     return {
         "id": channel_id,
@@ -253,32 +549,54 @@ async def delete_channel(channel_id: str):
         raise HTTPException(status_code=404, detail="Channel not found")
     
     del channels[channel_id]
-    save_channels()
+    app.state.channels_dirty.set()
     
     return {"ok": True}
 
 
+def _tail_jsonl(path: Path, n: int) -> list[bytes]:
+    """Return the last n non-empty lines of a file, reading backward in blocks."""
+    if n <= 0:
+        return []
+    chunks = []
+    newlines = 0
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        while pos and newlines <= n:
+            size = min(65536, pos)
+            pos -= size
+            f.seek(pos)
+            chunk = f.read(size)
+            newlines += chunk.count(b"\n")
+            chunks.append(chunk)
+    chunks.reverse()
+    buf = b"".join(chunks)
+    if pos:
+        # Everything before the first newline may be the tail of a cut record
+        buf = buf.partition(b"\n")[2]
+    lines = [line for line in buf.splitlines() if line.strip()]
+    return lines[-n:]
+
+
 @app.get("/logs")
 async def get_logs(limit: int = 50):
-    """Get recent webhook logs."""
+    """Get recent webhook logs, newest first (at most LOGS_MAX_LIMIT)."""
     logs = []
     log_dir = DATA_DIR / "logs"
+    limit = min(limit, LOGS_MAX_LIMIT)
     
-    if not log_dir.exists():
+    if limit <= 0 or not log_dir.exists():
         return {"logs": []}
     
     # Read from most recent files
     for log_file in sorted(log_dir.glob("*.jsonl"), reverse=True):
-        with open(log_file) as f:
-            for line in f:
-                if line.strip():
-                    logs.append(json.loads(line))
-                    if len(logs) >= limit:
-                        break
+        for line in reversed(_tail_jsonl(log_file, limit - len(logs))):
+            logs.append(json_loads(line))
         if len(logs) >= limit:
             break
     
-    return {"logs": logs[:limit]}
+    return {"logs": logs}
 
 
 @app.get("/health")
@@ -288,4 +606,5 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8082)
+    # access_log off: log_webhook already records every delivery
+    uvicorn.run(app, host="0.0.0.0", port=8082, loop="uvloop", http="httptools", access_log=False)